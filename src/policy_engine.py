@@ -1,14 +1,111 @@
 """
 Security policy engine for BlackRoad Security.
 Manages and enforces security policies across the organization.
+Requires Python 3.9 or newer (``ast.unparse``).
 """
 
+import ast
+import atexit
+import hashlib
 import json
+import logging
+import math
 import sqlite3
+import sys
+import threading
+import weakref
 from datetime import datetime, timedelta
+from types import CodeType
 from typing import Any, Dict, List, Optional, Callable
 from enum import Enum
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, fields
+
+logger = logging.getLogger(__name__)
+
+# Compact separators, cached once. ensure_ascii stays on: it is the only
+# form that can carry lone surrogates, and the output is always valid
+# UTF-8 to store.
+_dumps = json.JSONEncoder(separators=(",", ":")).encode
+
+# Buffered violations are flushed once this many are pending
+VIOLATION_BATCH_SIZE = 128
+
+_VIOLATION_COLUMNS = (
+    "violation_id", "rule_id", "timestamp", "subject",
+    "resource", "details", "severity"
+)
+
+# Errors that no retry can fix: the row itself cannot be stored
+_PERMANENT_WRITE_ERRORS = (
+    sqlite3.IntegrityError,
+    sqlite3.InterfaceError,
+    sqlite3.ProgrammingError,
+    sqlite3.DataError,
+    TypeError,
+    ValueError,
+    OverflowError,
+)
+
+
+def _sql_timestamp(value: datetime) -> str:
+    """Format a UTC datetime as fixed-width SQLite datetime text.
+
+    ``YYYY-MM-DD HH:MM:SS.ffffff`` sorts as a string against itself and
+    against the ``YYYY-MM-DD HH:MM:SS`` values ``datetime()`` returns.
+    Plain ``isoformat`` drops the fraction when it is zero, so the width
+    would vary.
+    """
+    return value.isoformat(" ", timespec="microseconds")
+
+
+def _check_bindable(row: tuple):
+    """Raise if SQLite would refuse to bind any value in a row.
+
+    Checking at buffer time keeps a bad row from reaching a batch, where
+    it would fail every write it is part of, and reports it to the
+    caller that produced it.
+    """
+    for value in row:
+        if value is None or isinstance(value, (float, bytes)):
+            continue
+        if isinstance(value, str):
+            value.encode("utf-8")
+        elif isinstance(value, int):
+            if not -2 ** 63 <= value < 2 ** 63:
+                raise OverflowError("int too large to store in SQLite")
+        else:
+            raise TypeError(f"cannot store {type(value).__name__} in SQLite")
+
+
+def _slotted_dataclass(**kwargs):
+    """``dataclass(slots=True, ...)``, with a manual fallback before 3.10."""
+    if sys.version_info >= (3, 10):
+        return dataclass(slots=True, **kwargs)
+
+    def wrap(cls):
+        cls = dataclass(**kwargs)(cls)
+        names = tuple(f.name for f in fields(cls))
+        # Defaults already live in __init__; class attributes would clash
+        namespace = {
+            k: v for k, v in cls.__dict__.items()
+            if k not in names and k not in ("__dict__", "__weakref__")
+        }
+        namespace["__slots__"] = names
+
+        # Default slot pickling restores state with setattr, which a
+        # frozen class refuses; mirror what slots=True generates
+        def __getstate__(self):
+            return [getattr(self, name) for name in names]
+
+        def __setstate__(self, state):
+            for name, value in zip(names, state):
+                object.__setattr__(self, name, value)
+
+        namespace["__getstate__"] = __getstate__
+        namespace["__setstate__"] = __setstate__
+        return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+    return wrap
 
 
 class PolicyAction(Enum):
@@ -20,7 +117,11 @@ class PolicyAction(Enum):
     REQUIRE_APPROVAL = "require_approval"
 
 
-@dataclass
+# Stored action strings mapped straight to enum members
+_ACTION_CACHE = {a.value: a for a in PolicyAction}
+
+
+@_slotted_dataclass(frozen=True)
 class PolicyRule:
     """Security policy rule."""
     rule_id: str
@@ -32,9 +133,12 @@ class PolicyRule:
     enabled: bool = True
 
 
-@dataclass
+@_slotted_dataclass(frozen=True)
 class PolicyViolation:
-    """Policy violation record."""
+    """Policy violation record.
+
+    Immutable but not hashable, since ``details`` is a dict.
+    """
     violation_id: str
     rule_id: str
     timestamp: datetime
@@ -44,36 +148,389 @@ class PolicyViolation:
     severity: str
 
 
+# Size caps for folded constants, mirroring CPython's AST optimizer
+_FOLD_MAX_INT_BITS = 128
+_FOLD_MAX_SEQ_LEN = 4096
+
+
+def _fold_is_bounded(op: ast.operator, left: Any, right: Any) -> bool:
+    """Check, before evaluating, that folding a BinOp stays small.
+
+    Only the operators that can blow up from small operands need a
+    pre-check; every folded result is also size-checked afterwards.
+    """
+    ints = (
+        isinstance(left, int) and not isinstance(left, bool)
+        and isinstance(right, int) and not isinstance(right, bool)
+    )
+    if isinstance(op, ast.Pow) and ints and right > 0:
+        return left.bit_length() * right <= _FOLD_MAX_INT_BITS
+    if isinstance(op, ast.LShift) and ints and right > 0:
+        return left.bit_length() + right <= _FOLD_MAX_INT_BITS
+    if isinstance(op, ast.Mult):
+        for seq, count in ((left, right), (right, left)):
+            if isinstance(seq, (str, bytes, tuple)) and isinstance(count, int):
+                return len(seq) * max(count, 0) <= _FOLD_MAX_SEQ_LEN
+    if isinstance(op, ast.Mod) and isinstance(left, (str, bytes)):
+        # printf-style widths can produce arbitrarily long strings
+        return False
+    return True
+
+
+def _fold_result_is_bounded(value: Any) -> bool:
+    """Reject folded constants too large to keep in the AST."""
+    if isinstance(value, int):
+        return value.bit_length() <= _FOLD_MAX_INT_BITS
+    if isinstance(value, (str, bytes, tuple)):
+        return len(value) <= _FOLD_MAX_SEQ_LEN
+    return True
+
+
+class _ConstantFolder(ast.NodeTransformer):
+    """Fold condition subexpressions whose operands are all constants."""
+
+    def _fold(self, node: ast.AST) -> ast.AST:
+        try:
+            code = compile(ast.Expression(node), "<fold>", "eval")
+            value = eval(code, {"__builtins__": {}})
+        except Exception:
+            return node
+        if not _fold_result_is_bounded(value):
+            return node
+        return ast.copy_location(ast.Constant(value), node)
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        if (
+            isinstance(node.left, ast.Constant)
+            and isinstance(node.right, ast.Constant)
+            and _fold_is_bounded(node.op, node.left.value, node.right.value)
+        ):
+            return self._fold(node)
+        return node
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.operand, ast.Constant):
+            return self._fold(node)
+        return node
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        if all(isinstance(v, ast.Constant) for v in node.values):
+            return self._fold(node)
+        return node
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        self.generic_visit(node)
+        operands = [node.left, *node.comparators]
+        if all(isinstance(v, ast.Constant) for v in operands):
+            return self._fold(node)
+        return node
+
+
+def _required_prefix(node: ast.AST) -> Optional[str]:
+    """Return a prefix `resource` must start with for the condition to hold.
+
+    Recognises ``resource.startswith('<literal>')`` either as the whole
+    condition or as one operand of a top-level ``and``.
+    """
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        for value in node.values:
+            prefix = _required_prefix(value)
+            if prefix is not None:
+                return prefix
+        return None
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Attribute)
+        and node.func.attr == "startswith"
+        and isinstance(node.func.value, ast.Name)
+        and node.func.value.id == "resource"
+        and len(node.args) == 1
+        and not node.keywords
+        and isinstance(node.args[0], ast.Constant)
+        and isinstance(node.args[0].value, str)
+    ):
+        return node.args[0].value
+    return None
+
+
+def _parse_condition(condition: str) -> Optional[ast.Expression]:
+    """Parse a condition and fold its constants, or None if invalid."""
+    try:
+        tree = ast.parse(condition, mode="eval")
+    except (SyntaxError, ValueError):
+        return None
+    return ast.fix_missing_locations(_ConstantFolder().visit(tree))
+
+
+def _normalize_condition(tree: ast.Expression, condition: str) -> str:
+    """Return the canonical source of a parsed condition.
+
+    Falls back to the raw source when the tree cannot be unparsed, e.g.
+    an int literal past ``sys.get_int_max_str_digits()``.
+    """
+    try:
+        return ast.unparse(tree)
+    except ValueError:
+        return condition
+
+
+class _PrefixTrie:
+    """Character trie answering which registered prefixes a string has."""
+
+    def __init__(self):
+        self._root: Dict[Any, Any] = {}
+
+    def add(self, prefix: str):
+        node = self._root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[None] = prefix
+
+    def matches(self, value: str) -> set:
+        """Return every registered prefix of ``value`` in one pass."""
+        found = set()
+        node = self._root
+        if None in node:
+            found.add(node[None])
+        for ch in value:
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                found.add(node[None])
+        return found
+
+
+class _BloomFilter:
+    """Fixed-size bloom filter over strings (no false negatives)."""
+
+    def __init__(self, capacity: int = 1024, error_rate: float = 1e-4):
+        self._size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, value: str):
+        # surrogatepass: any str a caller passes must hash, not raise
+        data = str(value).encode("utf-8", "surrogatepass")
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self._hashes):
+            yield (h1 + i * h2) % self._size
+
+    def add(self, value: str):
+        for pos in self._positions(value):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self._bits[pos >> 3] & (1 << (pos & 7))
+            for pos in self._positions(value)
+        )
+
+
+# Engines with possibly-unflushed violations, flushed at interpreter exit
+_LIVE_ENGINES: "weakref.WeakSet[PolicyEngine]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_live_engines():
+    """Flush every open engine so buffered violations survive exit."""
+    for engine in list(_LIVE_ENGINES):
+        try:
+            engine.flush()
+        except Exception:
+            logger.exception("failed to flush violations at exit")
+
+
 class PolicyEngine:
     """Production-grade security policy enforcement engine."""
 
-    def __init__(self, db_path: str = "policies.db"):
+    def __init__(
+        self,
+        db_path: str = "policies.db",
+        flush_interval: float = 1.0
+    ):
         """Initialize policy engine.
         
         Args:
             db_path: Path to SQLite database for policies
+            flush_interval: Max seconds a recorded violation stays buffered
         """
         self.db_path = db_path
+        self._conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        # Guards every statement on the shared connection. Reads hold it
+        # too: an unfinished read on this connection would pin a snapshot
+        # and make a concurrent write fail with SQLITE_BUSY immediately.
+        self._lock = threading.RLock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA cache_size=-20000")
         self._init_db()
         self._evaluators = {}
+        # rule_id -> (condition source, code, required prefix, normalized source)
+        self._compiled: Dict[str, tuple] = {}
+        # normalized condition -> (code, required prefix)
+        self._code_by_norm: Dict[str, tuple] = {}
+        self._flush_interval = flush_interval
+        self._violation_buf: List[tuple] = []
+        self._violation_lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        self._closed = False
+        _LIVE_ENGINES.add(self)
+        self._rules_rev = 0
+        # (revision key, snapshot), swapped as one object
+        self._rules_cache: tuple = (None, None)
+        self._data_version: Optional[int] = None
+        # Last seen policy_revisions counters
+        self._policies_rev: Optional[int] = None
+        self._exemptions_rev: Optional[int] = None
+        # Serializes bloom rebuilds with add_exemption so an exemption
+        # added mid-rebuild is not lost when the new filter is swapped in
+        self._bloom_lock = threading.Lock()
+        self._exempt_bloom = _BloomFilter()
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """Run a read on the shared connection and fetch every row."""
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        """Flush buffered violations and close the database connection.
+
+        A pending flush timer is cancelled, and one already running is
+        joined, before the final flush so no write races the close.
+        """
+        with self._violation_lock:
+            self._closed = True
+            timer, self._flush_timer = self._flush_timer, None
+        if timer is not None:
+            timer.cancel()
+            if timer is not threading.current_thread():
+                timer.join()
+        _LIVE_ENGINES.discard(self)
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._conn.close()
+
+    def flush(self):
+        """Write all buffered violations in a single transaction."""
+        with self._violation_lock:
+            rows, self._violation_buf = self._violation_buf, []
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        if rows:
+            self._flush_rows(rows)
+
+    def _schedule_flush(self):
+        """Arm the flush timer if needed; caller holds _violation_lock."""
+        if self._flush_timer is None and not self._closed:
+            self._flush_timer = threading.Timer(
+                self._flush_interval, self._timed_flush
+            )
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _timed_flush(self):
+        """Flush from the timer thread; failed rows stay buffered."""
+        try:
+            self.flush()
+        except Exception:
+            logger.warning("violation flush failed; will retry", exc_info=True)
+
+    def _requeue(self, rows: List[tuple]):
+        """Return unwritten rows to the front of the buffer."""
+        with self._violation_lock:
+            self._violation_buf[:0] = rows
+            self._schedule_flush()
+
+    def _flush_rows(self, rows: List[tuple]):
+        """Write rows, keeping them buffered if the database is unavailable.
+
+        A batch that fails for any other reason holds a row SQLite will
+        never accept, so rows are retried one at a time and only the
+        rows that fail permanently are dropped.
+        """
+        try:
+            self._write_violations(rows)
+            return
+        except _PERMANENT_WRITE_ERRORS:
+            pass
+        except Exception:
+            self._requeue(rows)
+            raise
+        for i, row in enumerate(rows):
+            try:
+                self._write_violations([row])
+            except _PERMANENT_WRITE_ERRORS:
+                logger.exception("dropping unwritable violation %s", row[0])
+            except Exception:
+                self._requeue(rows[i:])
+                raise
+
+    def _write_violations(self, rows: List[tuple]):
+        """Insert violation rows with one prepared executemany."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("""
+                    INSERT INTO policy_violations
+                    (violation_id, rule_id, timestamp, subject, resource, details, severity)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
 
     def _init_db(self):
         """Initialize policy database schema."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
+        conn = self._conn
+        actions = ", ".join(f"'{value}'" for value in _ACTION_CACHE)
+        with self._lock:
+            conn.execute(f"""
                 CREATE TABLE IF NOT EXISTS policies (
                     rule_id TEXT PRIMARY KEY,
                     name TEXT NOT NULL,
                     description TEXT,
                     condition TEXT NOT NULL,
-                    action TEXT NOT NULL,
+                    action TEXT NOT NULL CHECK (action IN ({actions})),
                     priority INTEGER NOT NULL,
+                    condition_norm TEXT,
                     enabled INTEGER DEFAULT 1,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_priority (priority),
-                    INDEX idx_enabled (enabled)
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_policies_enabled_prio
+                ON policies(enabled, priority DESC, rule_id, name, action, condition)
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_cond_norm "
+                "ON policies(condition_norm)"
+            )
+            # Writers that change a condition without its norm (anything
+            # but this engine) leave it NULL for find_equivalent_rules to
+            # fill in, rather than stale
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS policies_norm_reset
+                AFTER UPDATE OF condition ON policies
+                WHEN NEW.condition_norm IS OLD.condition_norm
+                BEGIN
+                    UPDATE policies SET condition_norm = NULL
+                    WHERE rule_id = NEW.rule_id;
+                END
+            """)
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS policy_violations (
                     violation_id TEXT PRIMARY KEY,
@@ -84,12 +541,21 @@ class PolicyEngine:
                     details TEXT,
                     severity TEXT,
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (rule_id) REFERENCES policies(rule_id),
-                    INDEX idx_timestamp (timestamp),
-                    INDEX idx_subject (subject),
-                    INDEX idx_severity (severity)
+                    FOREIGN KEY (rule_id) REFERENCES policies(rule_id)
                 )
             """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_timestamp "
+                "ON policy_violations(timestamp)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_subject "
+                "ON policy_violations(subject)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_severity "
+                "ON policy_violations(severity)"
+            )
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS policy_exemptions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -100,7 +566,44 @@ class PolicyEngine:
                     FOREIGN KEY (rule_id) REFERENCES policies(rule_id)
                 )
             """)
-            conn.commit()
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_exempt_lookup
+                ON policy_exemptions(subject, rule_id, expires_at)
+            """)
+            # Per-table change counters, so a commit from another
+            # connection only invalidates caches built from that table
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS policy_revisions (
+                    name TEXT PRIMARY KEY,
+                    rev INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            # Only the columns evaluation reads count as a change
+            watched = {
+                "policies": "rule_id, condition, action, priority, enabled",
+                "policy_exemptions": "rule_id, subject, expires_at",
+            }
+            for table, columns in watched.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO policy_revisions (name) VALUES (?)",
+                    (table,)
+                )
+                bump = (
+                    "UPDATE policy_revisions SET rev = rev + 1 "
+                    f"WHERE name = '{table}'"
+                )
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_rev_insert
+                    AFTER INSERT ON {table} BEGIN {bump}; END
+                """)
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_rev_delete
+                    AFTER DELETE ON {table} BEGIN {bump}; END
+                """)
+                conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_rev_update
+                    AFTER UPDATE OF {columns} ON {table} BEGIN {bump}; END
+                """)
 
     def add_rule(
         self,
@@ -124,17 +627,200 @@ class PolicyEngine:
         Returns:
             True if rule added successfully
         """
-        with sqlite3.connect(self.db_path) as conn:
+        tree = _parse_condition(condition)
+        condition_norm = (
+            _normalize_condition(tree, condition) if tree is not None else None
+        )
+        with self._lock:
             try:
-                conn.execute("""
+                self._conn.execute("""
                     INSERT INTO policies
-                    (rule_id, name, description, condition, action, priority)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (rule_id, name, description, condition, action.value, priority))
-                conn.commit()
-                return True
+                    (rule_id, name, description, condition, action, priority,
+                     condition_norm)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (rule_id, name, description, condition, action.value, priority,
+                      condition_norm))
             except sqlite3.IntegrityError:
                 return False
+            self._rules_rev += 1
+        self._compile_tree(rule_id, condition, tree)
+        return True
+
+    def find_equivalent_rules(self, condition: str) -> List[str]:
+        """Return ids of rules whose normalized condition matches."""
+        tree = _parse_condition(condition)
+        if tree is None:
+            return []
+        self._backfill_condition_norms()
+        rows = self._query(
+            "SELECT rule_id FROM policies WHERE condition_norm = ?",
+            (_normalize_condition(tree, condition),)
+        )
+        return [row[0] for row in rows]
+
+    def _backfill_condition_norms(self):
+        """Normalize conditions stored without a norm by other writers.
+
+        Conditions that do not parse stay NULL, as in ``add_rule``, and
+        never match. The update is skipped for a row whose condition
+        changed in the meantime.
+        """
+        with self._lock:
+            rows = self._query(
+                "SELECT rule_id, condition FROM policies "
+                "WHERE condition_norm IS NULL"
+            )
+            updates = []
+            for rule_id, condition in rows:
+                tree = _parse_condition(condition)
+                if tree is not None:
+                    updates.append(
+                        (_normalize_condition(tree, condition), rule_id, condition)
+                    )
+            if not updates:
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "UPDATE policies SET condition_norm = ? "
+                    "WHERE rule_id = ? AND condition = ?",
+                    updates
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
+
+    def add_exemption(
+        self,
+        rule_id: str,
+        subject: str,
+        expires_at: Optional[datetime] = None,
+        reason: Optional[str] = None
+    ) -> bool:
+        """Exempt a subject from a policy rule.
+        
+        Args:
+            rule_id: Rule the exemption applies to
+            subject: User or service being exempted
+            expires_at: UTC expiry time (None = never expires)
+            reason: Justification for the exemption
+            
+        Returns:
+            True if exemption added successfully
+        """
+        expires = _sql_timestamp(expires_at) if expires_at else None
+        with self._bloom_lock:
+            with self._lock:
+                self._conn.execute("""
+                    INSERT INTO policy_exemptions (rule_id, subject, expires_at, reason)
+                    VALUES (?, ?, ?, ?)
+                """, (rule_id, subject, expires, reason))
+            self._exempt_bloom.add(subject)
+        return True
+
+    def _sync_external_changes(self):
+        """Pick up commits made by other connections.
+
+        SQLite's ``data_version`` moves whenever a different connection
+        commits anything, so it only triggers a read of the per-table
+        revision counters. The rule snapshot is rebuilt only when the
+        ``policies`` counter moved; compiled conditions are checked
+        against their source on reuse and need no reset. The exemption
+        bloom filter is rebuilt only when ``policy_exemptions`` moved.
+        """
+        data_version = self._query("PRAGMA data_version")[0][0]
+        if data_version == self._data_version:
+            return
+        revs = dict(self._query("SELECT name, rev FROM policy_revisions"))
+        self._policies_rev = revs.get("policies")
+        exemptions_rev = revs.get("policy_exemptions")
+        if exemptions_rev != self._exemptions_rev:
+            self._rebuild_exempt_bloom()
+            self._exemptions_rev = exemptions_rev
+        self._data_version = data_version
+
+    def _rebuild_exempt_bloom(self):
+        """Reload the exempt-subject bloom filter from the database."""
+        with self._bloom_lock:
+            subjects = [
+                row[0] for row in
+                self._query("SELECT DISTINCT subject FROM policy_exemptions")
+            ]
+            bloom = _BloomFilter(capacity=max(1024, 2 * len(subjects)))
+            for subject in subjects:
+                bloom.add(subject)
+            self._exempt_bloom = bloom
+
+    def _load_rules(self) -> tuple:
+        """Return enabled rules in priority order, reloading only on change.
+
+        The result is an immutable snapshot ``(rules, trie)``. Each rule
+        tuple carries its own compiled code and required prefix, and the
+        trie is built from exactly those prefixes, so a concurrent cache
+        reset cannot leave an evaluation pruning against a different
+        generation than the one it evaluates.
+        """
+        self._sync_external_changes()
+        # Read before the rules so a concurrent change can only make the
+        # snapshot newer than its key, never older
+        key = (self._rules_rev, self._policies_rev)
+        cached_key, snapshot = self._rules_cache
+        if cached_key == key:
+            return snapshot
+        
+        rows = self._query("""
+            SELECT rule_id, condition, action, priority
+            FROM policies
+            WHERE enabled = 1
+            ORDER BY priority DESC
+        """)
+        rules = []
+        trie = _PrefixTrie()
+        for rule_id, condition, action, priority in rows:
+            code, prefix = self._compile_condition(rule_id, condition)
+            if prefix is not None:
+                trie.add(prefix)
+            rules.append((rule_id, code, prefix, _ACTION_CACHE[action], priority))
+        snapshot = (rules, trie)
+        self._rules_cache = (key, snapshot)
+        self._prune_compiled({rule[0] for rule in rules})
+        return snapshot
+
+    def _prune_compiled(self, live_ids: set):
+        """Drop compiled conditions no enabled rule uses any more.
+
+        New dicts are swapped in rather than deleting in place, so a
+        concurrent ``_compile_tree`` never sees a dict change under it;
+        an entry it adds meanwhile may be dropped and is recompiled on
+        next use.
+        """
+        compiled = {
+            rule_id: entry for rule_id, entry in list(self._compiled.items())
+            if rule_id in live_ids
+        }
+        norms = {entry[3] for entry in compiled.values()}
+        self._code_by_norm = {
+            norm: entry for norm, entry in list(self._code_by_norm.items())
+            if norm in norms
+        }
+        self._compiled = compiled
+
+    def _exempt_rules(self, subject: str, now: datetime) -> set:
+        """Return ids of rules the subject holds an active exemption for.
+
+        ``now`` is bound as text in SQLite's datetime format so expiry is a
+        plain string comparison instead of a ``datetime('now')`` call.
+        """
+        if subject not in self._exempt_bloom:
+            return set()
+        rows = self._query("""
+            SELECT rule_id FROM policy_exemptions
+            WHERE subject = ?
+            AND (expires_at IS NULL OR expires_at > ?)
+        """, (subject, _sql_timestamp(now)))
+        return {row[0] for row in rows}
 
     def evaluate_access(
         self,
@@ -155,25 +841,32 @@ class PolicyEngine:
         context = context or {}
         violations = []
         decisions = []
+        now = datetime.utcnow()
         
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("""
-                SELECT * FROM policies 
-                WHERE enabled = 1 
-                ORDER BY priority DESC
-            """)
-            rules = cursor.fetchall()
+        rules, prefix_trie = self._load_rules()
+        exempt = self._exempt_rules(subject, now)
         
-        for rule_row in rules:
-            rule_id, name, desc, condition, action, priority, *_ = rule_row
-            
+        # Prefixes the resource satisfies; None disables prefix pruning
+        # (non-string resource, or context shadowing `resource`)
+        matched_prefixes = None
+        if isinstance(resource, str) and "resource" not in context:
+            matched_prefixes = prefix_trie.matches(resource)
+        
+        for rule_id, code, prefix, action_enum, priority in rules:
             # Check exemption
-            if self._is_exempt(subject, rule_id):
+            if rule_id in exempt:
+                continue
+            
+            # Skip rules whose required resource prefix cannot match
+            if (
+                matched_prefixes is not None
+                and prefix is not None
+                and prefix not in matched_prefixes
+            ):
                 continue
             
             # Evaluate condition
-            if self._evaluate_condition(condition, subject, resource, context):
-                action_enum = PolicyAction(action)
+            if self._evaluate_condition(code, subject, resource, context):
                 decisions.append({
                     "rule_id": rule_id,
                     "action": action_enum.value,
@@ -182,7 +875,7 @@ class PolicyEngine:
                 
                 if action_enum == PolicyAction.DENY:
                     violation = self._record_violation(
-                        rule_id, subject, resource, context
+                        rule_id, subject, resource, context, now
                     )
                     violations.append(violation)
                     break  # Stop on first deny
@@ -193,7 +886,7 @@ class PolicyEngine:
             final_action = PolicyAction.DENY
         elif decisions:
             first_decision = decisions[0]
-            final_action = PolicyAction(first_decision["action"])
+            final_action = _ACTION_CACHE[first_decision["action"]]
         
         return {
             "decision": final_action.value,
@@ -201,63 +894,119 @@ class PolicyEngine:
             "resource": resource,
             "decisions": decisions,
             "violations": violations,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": now.isoformat()
         }
 
-    def _evaluate_condition(
+    def _compile_condition(
+        self,
+        rule_id: str,
+        condition: str
+    ) -> tuple:
+        """Compile a condition once and cache ``(code, prefix)`` by rule.
+
+        A cached entry is reused only while its source still matches.
+        Conditions that fail to compile are cached with code None so they
+        keep evaluating to False without being re-parsed.
+        """
+        entry = self._compiled.get(rule_id)
+        if entry is not None and entry[0] == condition:
+            return entry[1], entry[2]
+        return self._compile_tree(rule_id, condition, _parse_condition(condition))
+
+    def _compile_tree(
         self,
+        rule_id: str,
         condition: str,
+        tree: Optional[ast.Expression]
+    ) -> tuple:
+        """Compile a parsed condition and cache it for a rule.
+
+        Code objects are shared by normalized source, so rules whose
+        conditions differ only in spacing or constant arithmetic compile
+        once. The prefix is any ``resource.startswith`` literal the
+        condition requires, or None.
+        """
+        code, prefix, norm = None, None, None
+        if tree is not None:
+            norm = _normalize_condition(tree, condition)
+            if norm in self._code_by_norm:
+                code, prefix = self._code_by_norm[norm]
+            else:
+                try:
+                    code = compile(tree, "<policy>", "eval")
+                except (SyntaxError, ValueError):
+                    code = None
+                if code is not None:
+                    prefix = _required_prefix(tree.body)
+                self._code_by_norm[norm] = (code, prefix)
+        self._compiled[rule_id] = (condition, code, prefix, norm)
+        return code, prefix
+
+    def _evaluate_condition(
+        self,
+        code: Optional[CodeType],
         subject: str,
         resource: str,
         context: Dict[str, Any]
     ) -> bool:
-        """Evaluate policy condition string."""
+        """Evaluate a compiled policy condition."""
+        if code is None:
+            return False
         eval_globals = {
             "subject": subject,
             "resource": resource,
             **context
         }
         try:
-            return bool(eval(condition, {"__builtins__": {}}, eval_globals))
+            return bool(eval(code, {"__builtins__": {}}, eval_globals))
         except Exception:
             return False
 
-    def _is_exempt(self, subject: str, rule_id: str) -> bool:
-        """Check if subject is exempt from rule."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("""
-                SELECT 1 FROM policy_exemptions
-                WHERE rule_id = ? AND subject = ? 
-                AND (expires_at IS NULL OR expires_at > datetime('now'))
-            """, (rule_id, subject))
-            return cursor.fetchone() is not None
-
     def _record_violation(
         self,
         rule_id: str,
         subject: str,
         resource: str,
-        context: Dict[str, Any]
+        context: Dict[str, Any],
+        timestamp: datetime
     ) -> str:
-        """Record policy violation."""
+        """Buffer a policy violation for the next batched write.
+
+        The timestamp is stored as ``YYYY-MM-DD HH:MM:SS.ffffff`` text so
+        it compares correctly against ``datetime('now', ...)``.
+        A row SQLite could not store raises here, in the call that
+        produced it, instead of failing a later batch.
+        """
         import uuid
         violation_id = str(uuid.uuid4())
+        row = (
+            violation_id,
+            rule_id,
+            _sql_timestamp(timestamp),
+            subject,
+            resource,
+            _dumps(context),
+            "HIGH"
+        )
+        _check_bindable(row)
         
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT INTO policy_violations
-                (violation_id, rule_id, timestamp, subject, resource, details, severity)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                violation_id,
-                rule_id,
-                datetime.utcnow().isoformat(),
-                subject,
-                resource,
-                json.dumps(context),
-                "HIGH"
-            ))
-            conn.commit()
+        rows = None
+        with self._violation_lock:
+            self._violation_buf.append(row)
+            if len(self._violation_buf) >= VIOLATION_BATCH_SIZE:
+                rows, self._violation_buf = self._violation_buf, []
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+            else:
+                self._schedule_flush()
+        if rows:
+            # These rows are mostly other callers'; failures keep them
+            # buffered and must not fail this evaluation
+            try:
+                self._flush_rows(rows)
+            except Exception:
+                logger.warning("violation flush failed; will retry", exc_info=True)
         
         return violation_id
 
@@ -267,21 +1016,22 @@ class PolicyEngine:
         hours: int = 24
     ) -> List[Dict[str, Any]]:
         """Query policy violations."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            query = """
-                SELECT * FROM policy_violations 
-                WHERE timestamp > datetime('now', ?)
-            """
-            params = [f'-{hours} hours']
-            
-            if subject:
-                query += " AND subject = ?"
-                params.append(subject)
-            
-            query += " ORDER BY timestamp DESC"
-            cursor = conn.execute(query, params)
-            return [dict(row) for row in cursor.fetchall()]
+        self.flush()
+        query = """
+            SELECT violation_id, rule_id, timestamp, subject,
+                   resource, details, severity
+            FROM policy_violations 
+            WHERE timestamp > datetime('now', ?)
+        """
+        params = [f'-{hours} hours']
+        
+        if subject:
+            query += " AND subject = ?"
+            params.append(subject)
+        
+        query += " ORDER BY timestamp DESC"
+        rows = self._query(query, tuple(params))
+        return [dict(zip(_VIOLATION_COLUMNS, row)) for row in rows]
 
 
 if __name__ == "__main__":
@@ -304,3 +1054,4 @@ if __name__ == "__main__":
         context={"ip": "192.168.1.1"}
     )
     print(json.dumps(decision, indent=2))
+    engine.close()
@@ -0,0 +1,556 @@
+"""Tests for the security policy engine."""
+
+import ast
+import copy
+import json
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import policy_engine as pe  # noqa: E402
+from policy_engine import PolicyAction, PolicyEngine  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "policies.db")
+
+
+@pytest.fixture
+def engine(db_path):
+    engine = PolicyEngine(db_path, flush_interval=60)
+    yield engine
+    engine.close()
+
+
+def _count_violations(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM policy_violations").fetchone()[0]
+
+
+# ---- Shared connection ----
+
+def test_concurrent_evaluation_with_other_writer(engine, db_path, monkeypatch):
+    monkeypatch.setattr(pe, "VIOLATION_BATCH_SIZE", 8)
+    engine.add_rule("deny-all", "Deny", "", "True", PolicyAction.DENY, 1)
+    errors = []
+    stop = threading.Event()
+
+    def evaluate(n):
+        try:
+            for i in range(1500):
+                engine.evaluate_access(f"user{n}", f"/res{i}")
+                if i % 250 == 0:
+                    engine.get_violations(f"user{n}")
+        except Exception as exc:  # pragma: no cover - reported below
+            errors.append(exc)
+
+    def write():
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        try:
+            n = 0
+            while not stop.is_set():
+                conn.execute(
+                    "INSERT INTO policy_violations "
+                    "(violation_id, rule_id, timestamp, subject, resource) "
+                    "VALUES (?, 'other', datetime('now'), 'other', '/')",
+                    (f"other-{n}",)
+                )
+                n += 1
+                time.sleep(0.001)
+        finally:
+            conn.close()
+
+    writer = threading.Thread(target=write)
+    workers = [threading.Thread(target=evaluate, args=(n,)) for n in range(4)]
+    writer.start()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    stop.set()
+    writer.join()
+    engine.flush()
+
+    assert errors == []
+    with sqlite3.connect(db_path) as conn:
+        ours = conn.execute(
+            "SELECT COUNT(*) FROM policy_violations WHERE rule_id = 'deny-all'"
+        ).fetchone()[0]
+    assert ours == 4 * 1500
+
+
+# ---- Condition compilation ----
+
+def test_condition_is_compiled_once_per_source(engine):
+    engine.add_rule("r", "R", "", "resource == '/x'", PolicyAction.DENY, 1)
+    code, _ = engine._compile_condition("r", "resource == '/x'")
+    assert engine._compile_condition("r", "resource == '/x'")[0] is code
+    assert engine._compile_condition("r", "resource == '/y'")[0] is not code
+
+
+def test_invalid_condition_never_matches(engine):
+    engine.add_rule("bad", "Bad", "", "resource ==", PolicyAction.DENY, 1)
+    engine.add_rule("err", "Err", "", "missing_name", PolicyAction.DENY, 2)
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "allow"
+
+
+def test_constant_folding_folds_small_expressions():
+    tree = pe._parse_condition("subject == 'a' and (2 * 3) == 6")
+    assert ast.unparse(tree) == "subject == 'a' and True"
+
+
+@pytest.mark.parametrize("condition", [
+    "2 ** 10 ** 10",
+    "subject == 'a' * 10 ** 8",
+    "subject == '%0999999999d' % 1",
+    "1 << 10 ** 9",
+])
+def test_constant_folding_refuses_oversized_results(condition):
+    tree = pe._parse_condition(condition)
+    assert not any(
+        isinstance(node, ast.Constant) and len(repr(node.value)) > 4096
+        for node in ast.walk(tree)
+    )
+
+
+def test_find_equivalent_rules(engine):
+    engine.add_rule("a", "A", "", "resource.startswith('/x')  and  1 + 1 == 2",
+                    PolicyAction.DENY, 1)
+    engine.add_rule("b", "B", "", 'resource.startswith("/x") and True',
+                    PolicyAction.AUDIT, 2)
+    engine.add_rule("c", "C", "", "resource.startswith('/y')", PolicyAction.AUDIT, 3)
+    assert sorted(engine.find_equivalent_rules("resource.startswith('/x') and 2 == 2")) == ["a", "b"]
+    assert engine.find_equivalent_rules("not valid (") == []
+
+
+def test_find_equivalent_rules_sees_other_writers(engine, db_path):
+    engine.add_rule("a", "A", "", "resource == '/x'", PolicyAction.DENY, 1)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "INSERT INTO policies (rule_id, name, condition, action, priority) "
+            "VALUES ('b', 'B', 'resource  ==  \"/x\"', 'deny', 2)"
+        )
+    assert sorted(engine.find_equivalent_rules("resource == '/x'")) == ["a", "b"]
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE policies SET condition = 'False' WHERE rule_id = 'a'")
+    assert engine.find_equivalent_rules("resource == '/x'") == ["b"]
+    assert engine.find_equivalent_rules("False") == ["a"]
+
+
+def test_oversized_int_literal_does_not_break_evaluation(engine, db_path):
+    condition = "resource == 0x" + "f" * 4000
+    assert engine.add_rule("big", "Big", "", condition, PolicyAction.DENY, 1)
+    assert engine.find_equivalent_rules(condition) == ["big"]
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "INSERT INTO policies (rule_id, name, condition, action, priority) "
+            "VALUES ('big2', 'Big2', ?, 'deny', 2)",
+            ("resource == 0x" + "e" * 4000,)
+        )
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "allow"
+
+
+def test_removed_rules_leave_compile_caches(engine, db_path):
+    engine.add_rule("a", "A", "", "resource == '/a'", PolicyAction.DENY, 1)
+    engine.add_rule("b", "B", "", "resource == '/b'", PolicyAction.DENY, 1)
+    engine.evaluate_access("user:a", "/x")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DELETE FROM policies WHERE rule_id = 'a'")
+    engine.evaluate_access("user:a", "/x")
+    assert set(engine._compiled) == {"b"}
+    assert list(engine._code_by_norm) == ["resource == '/b'"]
+
+
+# ---- Prefix pruning ----
+
+def test_prefix_trie_matches():
+    trie = pe._PrefixTrie()
+    for prefix in ("/admin", "/admin/users", "/api"):
+        trie.add(prefix)
+    assert trie.matches("/admin/users/1") == {"/admin", "/admin/users"}
+    assert trie.matches("/ap") == set()
+    trie.add("")
+    assert trie.matches("/other") == {""}
+
+
+@pytest.mark.parametrize("resource", [
+    "/admin", "/admin/settings", "/adm", "/api/v1", "/apix", "/public", "", "/"
+])
+@pytest.mark.parametrize("subject", ["user:a", "admin:b"])
+def test_pruning_matches_unpruned_evaluation(engine, subject, resource):
+    engine.add_rule("admin", "Admin", "",
+                    "resource.startswith('/admin') and 'admin' not in subject",
+                    PolicyAction.DENY, 100)
+    engine.add_rule("api", "API", "", "resource.startswith('/api')",
+                    PolicyAction.REQUIRE_MFA, 50)
+    engine.add_rule("slash", "Slash", "", "resource.startswith('/') and ip == '10.0.0.1'",
+                    PolicyAction.AUDIT, 20)
+    engine.add_rule("any", "Any", "", "subject.endswith(':b')",
+                    PolicyAction.REQUIRE_APPROVAL, 10)
+
+    pruned = engine.evaluate_access(subject, resource, {"ip": "10.0.0.1"})
+    # A context key named `resource` disables pruning
+    unpruned = engine.evaluate_access(
+        subject, resource, {"ip": "10.0.0.1", "resource": resource}
+    )
+    assert pruned["decision"] == unpruned["decision"]
+    assert pruned["decisions"] == unpruned["decisions"]
+
+
+def test_snapshot_survives_concurrent_reload(engine, db_path):
+    engine.add_rule("admin", "Admin", "", "resource.startswith('/admin')",
+                    PolicyAction.DENY, 1)
+    load_rules = engine._load_rules
+
+    def load_then_reload():
+        # Another connection rewrites the rule and a second thread reloads
+        # right after this evaluation took its snapshot.
+        snapshot = load_rules()
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(
+                "UPDATE policies SET condition = 'False' WHERE rule_id = 'admin'"
+            )
+        load_rules()
+        return snapshot
+
+    engine._load_rules = load_then_reload
+    assert engine.evaluate_access("user:a", "/admin/secret")["decision"] == "deny"
+
+
+# ---- Rule cache ----
+
+def test_rule_change_from_other_connection_invalidates_cache(engine, db_path):
+    engine.add_rule("r", "R", "", "resource == '/x'", PolicyAction.DENY, 1)
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "deny"
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE policies SET condition = 'False' WHERE rule_id = 'r'")
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "allow"
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "INSERT INTO policies (rule_id, name, condition, action, priority) "
+            "VALUES ('r2', 'R2', 'True', 'require_mfa', 5)"
+        )
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "require_mfa"
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DELETE FROM policies WHERE rule_id = 'r2'")
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "allow"
+
+
+def test_unrelated_commit_keeps_rule_snapshot(engine, db_path):
+    engine.add_rule("r", "R", "", "resource == '/x'", PolicyAction.DENY, 1)
+    snapshot = engine._load_rules()
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "INSERT INTO policy_violations "
+            "(violation_id, rule_id, timestamp, subject, resource) "
+            "VALUES ('v', 'r', datetime('now'), 'other', '/')"
+        )
+        conn.execute("UPDATE policies SET description = 'd' WHERE rule_id = 'r'")
+    assert engine._load_rules() is snapshot
+
+
+def test_action_check_matches_enum(db_path):
+    PolicyEngine(db_path).close()
+    with sqlite3.connect(db_path) as conn:
+        for action in PolicyAction:
+            conn.execute(
+                "INSERT INTO policies (rule_id, name, condition, action, priority) "
+                "VALUES (?, 'N', 'True', ?, 1)", (action.name, action.value)
+            )
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute(
+                "INSERT INTO policies (rule_id, name, condition, action, priority) "
+                "VALUES ('bad', 'N', 'True', 'block', 1)"
+            )
+
+
+# ---- Exemptions ----
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = pe._BloomFilter(capacity=1000)
+    values = [f"user:{i}" for i in range(1000)] + ["user:\udc80"]
+    for value in values:
+        bloom.add(value)
+    assert all(value in bloom for value in values)
+    false_positives = sum(f"other:{i}" in bloom for i in range(10000))
+    assert false_positives < 10
+
+
+def test_exemption_from_other_connection_is_seen(engine, db_path):
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "deny"
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("INSERT INTO policy_exemptions (rule_id, subject) VALUES ('r', 'user:a')")
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "allow"
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DELETE FROM policy_exemptions")
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "deny"
+
+
+def test_unrelated_commit_keeps_exemption_filter(engine, db_path):
+    engine.add_rule("r", "R", "", "False", PolicyAction.DENY, 1)
+    engine.add_exemption("r", "user:a")
+    engine.evaluate_access("user:a", "/x")
+    bloom = engine._exempt_bloom
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "INSERT INTO policy_violations "
+            "(violation_id, rule_id, timestamp, subject, resource) "
+            "VALUES ('v', 'r', datetime('now'), 'other', '/')"
+        )
+        conn.execute("UPDATE policy_exemptions SET reason = 'why'")
+    engine.evaluate_access("user:a", "/x")
+    assert engine._exempt_bloom is bloom
+
+
+def test_exemption_added_during_rebuild_is_kept(engine, monkeypatch):
+    query = engine._query
+    adder = threading.Thread(target=engine.add_exemption, args=("r", "user:late"))
+
+    def query_during_add(sql, params=()):
+        rows = query(sql, params)
+        if "DISTINCT subject" in sql and not adder.is_alive():
+            adder.start()
+            adder.join(0.2)
+        return rows
+
+    monkeypatch.setattr(engine, "_query", query_during_add)
+    engine._rebuild_exempt_bloom()
+    adder.join()
+    assert "user:late" in engine._exempt_bloom
+
+
+def test_unencodable_subject_evaluates(engine):
+    engine.add_rule("r", "R", "", "resource == '/deny'", PolicyAction.DENY, 1)
+    assert engine.evaluate_access("user:\udc80", "/x")["decision"] == "allow"
+
+
+def test_exemption_applies_and_expires(engine):
+    engine.add_rule("deny_all", "Deny all", "", "True", PolicyAction.DENY, 1)
+    now = datetime.utcnow()
+    engine.add_exemption("deny_all", "user:a")
+    engine.add_exemption("deny_all", "user:b", expires_at=now + timedelta(hours=1))
+    engine.add_exemption("deny_all", "user:c", expires_at=now - timedelta(seconds=1))
+    expires = now.replace(microsecond=0) + timedelta(seconds=1)
+    engine.add_exemption("deny_all", "user:e", expires_at=expires)
+
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "allow"
+    assert engine.evaluate_access("user:b", "/x")["decision"] == "allow"
+    assert engine.evaluate_access("user:c", "/x")["decision"] == "deny"
+    assert engine.evaluate_access("user:d", "/x")["decision"] == "deny"
+    tick = timedelta(microseconds=1)
+    assert engine._exempt_rules("user:e", expires - tick) == {"deny_all"}
+    assert engine._exempt_rules("user:e", expires) == set()
+    assert engine._exempt_rules("user:e", expires + tick) == set()
+
+
+def test_exemption_is_per_rule(engine):
+    engine.add_rule("high", "High", "", "True", PolicyAction.DENY, 10)
+    engine.add_rule("low", "Low", "", "True", PolicyAction.AUDIT, 1)
+    engine.add_exemption("high", "user:a")
+    result = engine.evaluate_access("user:a", "/x")
+    assert result["decision"] == "audit"
+    assert [d["rule_id"] for d in result["decisions"]] == ["low"]
+    assert engine.evaluate_access("user:b", "/x")["decision"] == "deny"
+
+
+# ---- Violation recording ----
+
+def test_buffered_violations_visible_in_get_violations(engine, db_path):
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    result = engine.evaluate_access("user:a", "/x")
+    assert result["decision"] == "deny"
+    assert _count_violations(db_path) == 0
+
+    violations = engine.get_violations(subject="user:a")
+    assert [v["violation_id"] for v in violations] == result["violations"]
+    assert violations[0]["rule_id"] == "r"
+    assert engine.get_violations(subject="user:b") == []
+
+
+def test_get_violations_returns_column_dicts(engine):
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    engine.evaluate_access("user:a", "/x", {"ip": "10.0.0.1"})
+    (violation,) = engine.get_violations()
+    assert tuple(violation) == pe._VIOLATION_COLUMNS
+    assert violation["resource"] == "/x"
+    assert json.loads(violation["details"]) == {"ip": "10.0.0.1"}
+    assert violation["severity"] == "HIGH"
+
+
+def test_violation_timestamps_are_fixed_width(engine):
+    now = datetime.utcnow().replace(microsecond=0)
+    engine._record_violation("r", "user:a", "/x", {}, now)
+    engine._record_violation("r", "user:a", "/y", {}, now + timedelta(microseconds=5))
+    stamps = sorted(v["timestamp"] for v in engine.get_violations())
+    assert stamps == [
+        now.strftime("%Y-%m-%d %H:%M:%S.000000"),
+        now.strftime("%Y-%m-%d %H:%M:%S.000005"),
+    ]
+
+
+def test_get_violations_respects_time_window(engine, db_path):
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    engine.evaluate_access("user:a", "/x")
+    engine.flush()
+    assert len(engine.get_violations(hours=1)) == 1
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE policy_violations SET timestamp = datetime('now', '-2 hours')")
+    assert engine.get_violations(hours=1) == []
+    assert len(engine.get_violations(hours=3)) == 1
+
+
+def test_violation_details_keep_any_json_value(engine):
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    context = {"s": "caf\u00e9 \udc80", 1: "int key", "n": 2 ** 70,
+               "nan": float("nan"), "inf": float("inf")}
+    engine.evaluate_access("user:a", "/x", context)
+    (violation,) = engine.get_violations()
+    assert violation["details"].isascii()
+    assert '"nan":NaN' in violation["details"]
+    assert '"inf":Infinity' in violation["details"]
+    details = json.loads(violation["details"])
+    assert details["s"] == "caf\u00e9 \udc80"
+    assert details["1"] == "int key"
+    assert details["n"] == 2 ** 70
+
+
+def test_violations_written_at_batch_size(engine, db_path, monkeypatch):
+    monkeypatch.setattr(pe, "VIOLATION_BATCH_SIZE", 3)
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    for _ in range(2):
+        engine.evaluate_access("user:a", "/x")
+    assert _count_violations(db_path) == 0
+    engine.evaluate_access("user:a", "/x")
+    assert _count_violations(db_path) == 3
+
+
+def test_flush_timer_writes_violations(db_path):
+    engine = PolicyEngine(db_path, flush_interval=0.05)
+    try:
+        engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+        engine.evaluate_access("user:a", "/x")
+        deadline = time.monotonic() + 5
+        while _count_violations(db_path) == 0 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert _count_violations(db_path) == 1
+    finally:
+        engine.close()
+
+
+def test_unavailable_database_requeues_rows(engine, db_path, monkeypatch):
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    engine.evaluate_access("user:a", "/x")
+
+    write = engine._write_violations
+
+    def fail(rows):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(engine, "_write_violations", fail)
+    with pytest.raises(sqlite3.OperationalError):
+        engine.flush()
+    assert len(engine._violation_buf) == 1
+
+    monkeypatch.setattr(engine, "_write_violations", write)
+    engine.flush()
+    assert _count_violations(db_path) == 1
+
+
+def test_threshold_flush_failure_does_not_fail_evaluation(engine, monkeypatch):
+    monkeypatch.setattr(pe, "VIOLATION_BATCH_SIZE", 2)
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+
+    def fail(rows):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(engine, "_write_violations", fail)
+    for _ in range(3):
+        assert engine.evaluate_access("user:a", "/x")["decision"] == "deny"
+    assert len(engine._violation_buf) == 3
+
+
+def test_unstorable_violation_fails_only_its_own_call(engine, db_path):
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    with pytest.raises(UnicodeEncodeError):
+        engine.evaluate_access("user:a", "/\udc80")
+    with pytest.raises(TypeError):
+        engine.evaluate_access("user:a", ["/x"])
+
+    assert engine.evaluate_access("user:a", "/x")["decision"] == "deny"
+    assert len(engine.get_violations()) == 1
+    pe._flush_live_engines()
+    assert _count_violations(db_path) == 1
+
+
+def test_poison_row_is_dropped_and_rest_written(engine, db_path):
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    engine.evaluate_access("user:a", "/x")
+    # Bypass the buffer-time check, as a row that only fails on insert
+    engine._violation_buf.append(engine._violation_buf[0])
+    engine.evaluate_access("user:b", "/x")
+
+    assert {v["subject"] for v in engine.get_violations()} == {"user:a", "user:b"}
+    assert engine._violation_buf == []
+    engine.evaluate_access("user:c", "/x")
+    engine.flush()
+    assert _count_violations(db_path) == 3
+
+
+def test_close_flushes_and_is_idempotent(db_path):
+    engine = PolicyEngine(db_path, flush_interval=60)
+    engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+    engine.evaluate_access("user:a", "/x")
+    engine.close()
+    engine.close()
+    assert _count_violations(db_path) == 1
+    assert engine not in pe._LIVE_ENGINES
+
+
+def test_exit_hook_flushes_open_engines(db_path):
+    engine = PolicyEngine(db_path, flush_interval=60)
+    try:
+        engine.add_rule("r", "R", "", "True", PolicyAction.DENY, 1)
+        engine.evaluate_access("user:a", "/x")
+        pe._flush_live_engines()
+        assert _count_violations(db_path) == 1
+    finally:
+        engine.close()
+
+
+# ---- Records ----
+
+def test_records_are_slotted_and_frozen():
+    rule = pe.PolicyRule("r", "R", "", "True", PolicyAction.DENY, 1)
+    assert not hasattr(rule, "__dict__")
+    with pytest.raises(AttributeError):
+        rule.priority = 2
+    assert hash(rule) == hash(pe.PolicyRule("r", "R", "", "True", PolicyAction.DENY, 1))
+
+
+def test_records_copy_and_pickle():
+    rule = pe.PolicyRule("r", "R", "", "True", PolicyAction.DENY, 1)
+    violation = pe.PolicyViolation(
+        "v", "r", datetime(2024, 1, 1), "user:a", "/x", {"ip": "10.0.0.1"}, "HIGH"
+    )
+    for record in (rule, violation):
+        assert pickle.loads(pickle.dumps(record)) == record
+        assert copy.copy(record) == record
+        assert copy.deepcopy(record) == record